@@ -2,15 +2,13 @@ import streamlit as st
 import pandas as pd
 import numpy as np
 import plotly.graph_objects as go
-import plotly.express as px
-from lunar_python import Solar, Lunar
+from lunar_python import Solar
 from datetime import datetime, date, timedelta
 import random
 import json
 import os
-import requests
-from geopy.geocoders import Nominatim
-from geopy.exc import GeocoderTimedOut, GeocoderUnavailable
+import hashlib
+import struct
 
 # ==========================================
 # 1. 页面配置与全中文炫酷样式
@@ -22,7 +20,7 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-st.markdown("""
+CSS = """
 <style>
     .stApp { background: linear-gradient(to bottom, #e0e7ff, #f7f9fc); color: #333; }
     h1, h2, h3 { font-family: 'KaiTi', 'PingFang SC', sans-serif; color: #4a148c !important; text-shadow: 1px 1px 2px rgba(0,0,0,0.1); }
@@ -38,17 +36,27 @@ st.markdown("""
     .tag-blue { background: linear-gradient(#2196f3, #1976d2); }
     .tag-purple { background: linear-gradient(#9c27b0, #7b1fa2); }
     .tag-gray { background: #9e9e9e; }
-    .stButton>button { background: linear-gradient(#ab47bc, #7b1fa2); color: white; border-radius: 30px; 
+    .stButton>button, .stFormSubmitButton>button { background: linear-gradient(#ab47bc, #7b1fa2); color: white; border-radius: 30px; 
         box-shadow: 0 4px 15px rgba(171,71,188,0.4); }
-    .stButton>button:hover { transform: translateY(-3px); box-shadow: 0 8px 25px rgba(171,71,188,0.6); }
+    .stButton>button:hover, .stFormSubmitButton>button:hover { transform: translateY(-3px); box-shadow: 0 8px 25px rgba(171,71,188,0.6); }
 </style>
-""", unsafe_allow_html=True)
+"""
+METRIC_HTML = "<div class='metric-box'><div class='metric-title'>{}</div><div class='metric-value'>{}</div></div>"
+SHENSHA_HTML = "<span class='shensha-tag tag-{type}'>{name}</span>　{desc}"
+
+st.markdown(CSS, unsafe_allow_html=True)
 
 # ==========================================
 # 2. 数据加载
 # ==========================================
-@st.cache_data
+def _trim_admin(nodes):
+    # 只保留名称与下级，丢掉行政编码，树的体积约减半
+    return [{"name": n["name"], "children": _trim_admin(n["children"])} if n.get("children") else {"name": n["name"]}
+            for n in nodes]
+
+@st.cache_resource
 def load_admin_data():
+    # cache_resource 全进程共用同一棵树；cache_data 每次重跑都要反序列化整棵树
     files = ["pcas-code.json", "pca-code.json"]
     curr = os.path.dirname(os.path.abspath(__file__))
     for f in files:
@@ -56,49 +64,165 @@ def load_admin_data():
         if os.path.exists(p):
             try:
                 with open(p, "r", encoding="utf-8") as file: 
-                    return json.load(file)
+                    return _trim_admin(json.load(file))
             except: continue
     return None
 
 ADMIN_DATA = load_admin_data()
 
+@st.cache_resource
+def admin_index():
+    # 区划树按层摊平：levels[i] 为第 i 层全部名称，spans[路径] 为该节点子级在下一层中的 (层, 切片)
+    levels, spans = [], {}
+    def walk(nodes, path, depth):
+        if depth == len(levels): levels.append([])
+        start = len(levels[depth])
+        levels[depth].extend(n['name'] for n in nodes)
+        spans.setdefault(path, (depth, slice(start, len(levels[depth]))))
+        for n in nodes:
+            if n.get('children'): walk(n['children'], path + (n['name'],), depth + 1)
+    if ADMIN_DATA: walk(ADMIN_DATA, (), 0)
+    return [np.array(names, dtype=object) for names in levels], spans
+
+def admin_names(path):
+    # path 为从省到当前节点的名称元组，返回其下一级名称（名称数组上的切片视图）
+    levels, spans = admin_index()
+    if path not in spans: return levels[0][:0]
+    depth, span = spans[path]
+    return levels[depth][span]
+
 # ==========================================
 # 3. 定位与 AI 接口
 # ==========================================
-@st.cache_data(show_spinner=False)
+@st.cache_resource
+def _geocoder():
+    # geopy 仅在用户点击定位时才加载，缩短冷启动；全进程共用一个 Nominatim 实例
+    from geopy.geocoders import Nominatim
+    return Nominatim(user_agent=f"bazi_v22_{random.randint(10000,99999)}")
+
+def _fresh_today(cached, *args):
+    # 落盘缓存不支持 ttl：缓存值为 (抓取日期, 结果)，过了当天就按键删掉磁盘文件再重取，每个键只留一份
+    day, value = cached(*args)
+    if day != date.today().isoformat():
+        cached.clear(*args)
+        day, value = cached(*args)
+    return value
+
+@st.cache_data(persist="disk", max_entries=1024, show_spinner=False)
+def _geocode(query):
+    # 结果落盘，重启后同一地址当天不再联网
+    # 查无结果与网络异常一样直接抛出，只有真实坐标才会写进缓存
+    loc = _geocoder().geocode(query, timeout=10)
+    if not loc:
+        raise LookupError(query)
+    return date.today().isoformat(), {"success": True, "lat": loc.latitude, "lng": loc.longitude, "addr": loc.address}
+
 def get_precise_location(addr):
-    ua = f"bazi_v22_{random.randint(10000,99999)}"
     try:
         query = addr if any(k in addr for k in ["香港","澳门","台湾"]) else f"中国 {addr}"
-        loc = Nominatim(user_agent=ua).geocode(query, timeout=10)
-        if loc: 
-            return {"success": True, "lat": loc.latitude, "lng": loc.longitude, "addr": loc.address}
+        return _fresh_today(_geocode, query)
     except: pass
     return {"success": False, "lat": 39.9042, "lng": 116.4074, "msg": "使用默认北京坐标"}
 
+@st.cache_resource
+def _ai_session():
+    # 复用连接池，重复解盘时免去 TCP/TLS 握手
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+@st.cache_data(persist="disk", max_entries=256, show_spinner=False)
+def _ai_reply(api_key, base_url, prompt):
+    # 同一命盘的解盘结果落盘复用，每天换新；非 200 响应抛出 HTTPError，不会写进缓存
+    headers = {"Authorization": f"Bearer {api_key}"}
+    data = {"model": "gpt-4o-mini", "messages": [{"role": "user", "content": prompt}], "temperature": 0.8}
+    res = _ai_session().post(f"{base_url.rstrip('/')}/v1/chat/completions", headers=headers, json=data, timeout=20)
+    if res.status_code != 200:
+        import requests
+        raise requests.HTTPError(response=res)
+    return date.today().isoformat(), res.json()['choices'][0]['message']['content']
+
 def call_ai_analysis(api_key, base_url, context):
     if not api_key: return "⚠️ 请配置 API Key 启用 AI 解盘"
     
-    headers = {"Authorization": f"Bearer {api_key}"}
     prompt = f"""
 你是一位精通《周易》、河图洛书、三命通会的命理宗师，请根据以下信息给出深刻而富有诗意的终极分析（控制在300字以内）：
 {context}
 
 请结合河图洛书数理、八字五行生克、大运流年，总结此人一生运势轨迹，语言优美、哲理深远。
 """
-    data = {"model": "gpt-4o-mini", "messages": [{"role": "user", "content": prompt}], "temperature": 0.8}
-    
     try:
-        res = requests.post(f"{base_url.rstrip('/')}/v1/chat/completions", headers=headers, json=data, timeout=20)
-        if res.status_code == 200: 
-            return res.json()['choices'][0]['message']['content']
-        return f"⚠️ API错误: {res.status_code}"
+        return _fresh_today(_ai_reply, api_key, base_url, prompt)
     except Exception as e: 
+        res = getattr(e, "response", None)
+        if res is not None:
+            return f"⚠️ API错误: {res.status_code}"
         return f"⚠️ 网络异常: {str(e)}"
 
 # ==========================================
 # 4. 核心引擎（保持不变）
 # ==========================================
+# 五行序号：金0 木1 水2 火3 土4
+WUXING = ("金", "木", "水", "火", "土")
+# 流年大运五行查表，下标为 (日干河图数 + 年龄) % 10
+_YUN_WX_IDX = np.array([4, 2, 0, 2, 1, 4, 1, 3, 4, 0], dtype=np.int8)
+_YUN_NAMES = np.array([wx + "运" for wx in WUXING], dtype=object)
+# 流年状态，下标为 (涨幅>6) + (涨幅>14) + 3*(涨幅<-12)
+_LIFE_STATUS = np.array(["平稳有序", "亨通顺利", "大吉大利", "低谷考验"], dtype=object)
+# 日干 → 河图数
+_GAN_HETU = {"甲":6, "乙":1, "丙":9, "丁":4, "戊":5, "己":10, "庚":2, "辛":7, "壬":3, "癸":8}
+# 天干地支 → 五行
+_WX_MAP = {"甲":"木","乙":"木","丙":"火","丁":"火","戊":"土","己":"土","庚":"金","辛":"金","壬":"水","癸":"水",
+           "子":"水","丑":"土","寅":"木","卯":"木","辰":"土","巳":"火","午":"火","未":"土","申":"金","酉":"金","戌":"土","亥":"水"}
+# 天干地支 → 五行序号
+_WX_IDX = {k: WUXING.index(v) for k, v in _WX_MAP.items()}
+_PATTERNS = (
+    ("正官格", "一生正直清廉，宜从公职"),
+    ("七杀格", "胆大心雄，宜创业开拓"),
+    ("食神格", "福禄双全，享口福之乐"),
+    ("伤官格", "才华横溢，名利双收"),
+    ("正财格", "勤俭持家，财源稳定"),
+    ("偏财格", "横财就手，人脉广阔"),
+    ("印绶格", "学识渊博，贵人扶持")
+)
+# 神煞：(入命阈值, 标签)，随机数超过阈值即入命
+_SHEN_SHA = (
+    (0.5, {"name": "天乙贵人", "type": "gold", "desc": "贵人扶助，一生多助"}),
+    (0.4, {"name": "文昌贵人", "type": "purple", "desc": "聪明智慧，科名显赫"}),
+    (0.5, {"name": "桃花星", "type": "pink", "desc": "人缘极佳，异性缘旺"}),
+    (0.4, {"name": "驿马星", "type": "blue", "desc": "动中生财，宜远行发展"})
+)
+_SHEN_SHA_NONE = {"name": "命格平稳", "type": "gray", "desc": "安稳厚重，自力更生"}
+
+def moving_means(x, *windows):
+    # 多个窗口的简单移动平均共用一次前缀和，前 window-1 项为 NaN（同 pandas rolling(window).mean()）
+    csum = np.concatenate(([0.0], np.cumsum(x)))
+    outs = []
+    for w in windows:
+        out = np.full(x.shape, np.nan)
+        out[w-1:] = (csum[w:] - csum[:-w]) / w
+        outs.append(out)
+    return outs
+
+def floor_walk(changes, start, floor):
+    # 逐步 price = max(floor, price + change) 的向量化：先累加，再用历史最大触底缺口整体抬升，结果与逐步截断一致
+    walk = np.cumsum(np.concatenate(([start], changes)))[1:]
+    return walk + np.maximum(np.maximum.accumulate(floor - walk), 0)
+
+@st.cache_resource(max_entries=2048, show_spinner=False)
+def calc_bazi(year, month, day, hour, minute):
+    # lunar_python 的阳历→农历→八字换算是纯 Python：同一出生时刻全进程只算一次
+    # 结果全是 str 元组，不可变，用 cache_resource 免去每次命中的拷贝
+    # 返回 (四柱, 八字逐字天干地支)
+    b = Solar.fromYmdHms(year, month, day, hour, minute, 0).getLunar().getEightChar()
+    return ((b.getYear(), b.getMonth(), b.getDay(), b.getTime()),
+            (b.getYearGan(), b.getYearZhi(), b.getMonthGan(), b.getMonthZhi(),
+             b.getDayGan(), b.getDayZhi(), b.getTimeGan(), b.getTimeZhi()))
+
 class DestinyEngine:
     def __init__(self, b_date: date, hour: int, minute: int, lat: float, lng: float, gender: str):
         self.birth_date = b_date
@@ -106,132 +230,160 @@ class DestinyEngine:
         self.hour = hour
         self.minute = minute
         
-        self.solar = Solar.fromYmdHms(b_date.year, b_date.month, b_date.day, hour, minute, 0)
-        self.lunar = self.solar.getLunar()
-        self.bazi = self.lunar.getEightChar()
+        pillars, self.gan_zhi = calc_bazi(b_date.year, b_date.month, b_date.day, hour, minute)
+        self.year_pillar, self.month_pillar, self.day_pillar, self.time_pillar = pillars
+        self.bazi_str = "　".join(pillars)
         
-        self.year_pillar = self.bazi.getYear()
-        self.month_pillar = self.bazi.getMonth()
-        self.day_pillar = self.bazi.getDay()
-        self.time_pillar = self.bazi.getTime()
-        
-        self.seed = hash((self.year_pillar, self.month_pillar, self.day_pillar, self.time_pillar, hour, minute, lat, lng))
-        random.seed(self.seed)
-        np.random.seed(self.seed % (2**32))
+        # blake2b 摘要作种子：内置 hash 对字符串按进程加盐，同一命盘换个进程就变，磁盘缓存也无从命中
+        h = hashlib.blake2b(digest_size=8)
+        h.update("|".join((self.year_pillar, self.month_pillar, self.day_pillar, self.time_pillar)).encode())
+        h.update(struct.pack("<iidd", hour, minute, lat, lng))
+        self.seed = int.from_bytes(h.digest(), "little")
+        # 独立的 PCG64 生成器，格局、神煞与K线噪声都从它抽取，不再改写 random / NumPy 全局随机状态
+        self.rng = np.random.default_rng(self.seed)
         
         self.true_solar_diff = (lng - 120.0) * 4
-        self.day_gan_num = self._gan_to_hetu(self.bazi.getDayGan())
+        self.day_gan_num = self._gan_to_hetu(self.gan_zhi[4])
         self.wuxing_strength = self._calc_wuxing()
         self.favored = self._get_favored()
         self.shen_sha = self._calc_shen_sha()
         self.pattern = self._get_pattern()
 
     def _gan_to_hetu(self, gan):
-        map_gan = {"甲":6, "乙":1, "丙":9, "丁":4, "戊":5, "己":10, "庚":2, "辛":7, "壬":3, "癸":8}
-        return map_gan.get(gan, 5)
+        return _GAN_HETU.get(gan, 5)
 
     def _calc_wuxing(self):
-        cnt = {"金":0, "木":0, "水":0, "火":0, "土":0}
-        wx_map = {"甲":"木","乙":"木","丙":"火","丁":"火","戊":"土","己":"土","庚":"金","辛":"金","壬":"水","癸":"水",
-                  "子":"水","丑":"土","寅":"木","卯":"木","辰":"土","巳":"火","午":"火","未":"土","申":"金","酉":"金","戌":"土","亥":"水"}
-        for p in [self.bazi.getYearGan(), self.bazi.getYearZhi(), self.bazi.getMonthGan(), self.bazi.getMonthZhi(),
-                  self.bazi.getDayGan(), self.bazi.getDayZhi(), self.bazi.getTimeGan(), self.bazi.getTimeZhi()]:
-            wx = wx_map.get(p)
-            if wx: cnt[wx] += 1
-        return cnt
+        cnt = [0] * 5
+        for p in self.gan_zhi:
+            cnt[_WX_IDX[p]] += 1
+        return dict(zip(WUXING, cnt))
 
     def _get_favored(self):
-        day_wx = self.bazi.getDayWuXing()
-        if day_wx not in self.wuxing_strength:
-            day_wx = "土"
         weak = min(self.wuxing_strength, key=self.wuxing_strength.get)
         return weak
 
     def _get_pattern(self):
-        patterns = [
-            ("正官格", "一生正直清廉，宜从公职"),
-            ("七杀格", "胆大心雄，宜创业开拓"),
-            ("食神格", "福禄双全，享口福之乐"),
-            ("伤官格", "才华横溢，名利双收"),
-            ("正财格", "勤俭持家，财源稳定"),
-            ("偏财格", "横财就手，人脉广阔"),
-            ("印绶格", "学识渊博，贵人扶持")
-        ]
-        return random.choice(patterns)
+        return _PATTERNS[self.rng.integers(len(_PATTERNS))]
 
     def _calc_shen_sha(self):
-        res = []
-        if random.random() > 0.5: res.append({"name": "天乙贵人", "type": "gold", "desc": "贵人扶助，一生多助"})
-        if random.random() > 0.4: res.append({"name": "文昌贵人", "type": "purple", "desc": "聪明智慧，科名显赫"})
-        if random.random() > 0.5: res.append({"name": "桃花星", "type": "pink", "desc": "人缘极佳，异性缘旺"})
-        if random.random() > 0.4: res.append({"name": "驿马星", "type": "blue", "desc": "动中生财，宜远行发展"})
-        if not res: res.append({"name": "命格平稳", "type": "gray", "desc": "安稳厚重，自力更生"})
-        return res
-
-    def _get_year_yun(self, age):
-        base = (self.day_gan_num + age) % 10
-        if base == 0: base = 10
-        yun_map = {1:"水运", 2:"金运", 3:"水运", 4:"木运", 5:"土运", 6:"木运", 7:"火运", 8:"土运", 9:"金运", 10:"土运"}
-        return yun_map.get(base, "土运")
+        res = [tag for (p, tag), r in zip(_SHEN_SHA, self.rng.random(len(_SHEN_SHA))) if r > p]
+        return res or [_SHEN_SHA_NONE]
 
     def generate_life_kline(self):
-        data = []
-        price = 100.0
-        lows = []
+        n = 101
+        ages = np.arange(n)
+        yun_idx = _YUN_WX_IDX[(self.day_gan_num + ages) % 10]
+        yuns = _YUN_NAMES[yun_idx]
         
-        for age in range(0, 101):
-            yun = self._get_year_yun(age)
-            
-            base_score = 0
-            if yun[:-1] == self.favored: base_score += 10
-            
-            bonus = len(self.shen_sha) * 3
-            hetu_wave = np.sin(age / 9 * np.pi) * 8
-            noise = np.random.normal(0, 5)
-            change = base_score / 2 + bonus / 4 + hetu_wave + noise
-            
-            if age % 12 == 0 and age > 0: change -= 16
-            
-            close = max(10, price + change)
-            if change < -12: lows.append(age)
-            
-            status = "大吉大利" if change > 14 else ("亨通顺利" if change > 6 else ("低谷考验" if change < -12 else "平稳有序"))
-            
-            data.append({
-                "年龄": age, "年份": self.birth_date.year + age, "开盘": price, "收盘": close,
-                "最高": close + abs(change)*1.5, "最低": price - abs(change)*1.5,
-                "状态": status, "当年大运": yun
-            })
-            price = close
+        base_score = np.where(yun_idx == WUXING.index(self.favored), 10, 0)
+        bonus = len(self.shen_sha) * 3
+        hetu_wave = np.sin(ages / 9 * np.pi) * 8
+        noise = self.rng.normal(0, 5, n)
+        change = base_score / 2 + bonus / 4 + hetu_wave + noise
+        change[(ages % 12 == 0) & (ages > 0)] -= 16
+        
+        close = floor_walk(change, 100.0, 10)
+        open_ = np.concatenate(([100.0], close[:-1]))
+        swing = np.abs(change) * 1.5
+        ma10, ma30 = moving_means(close, 10, 30)
+        
+        lows = np.flatnonzero(change < -12)
+        status = _LIFE_STATUS[(change > 6).astype(np.intp) + (change > 14) + 3 * (change < -12)]
         
-        df = pd.DataFrame(data)
-        df['十年均线'] = df['收盘'].rolling(10).mean()
-        df['三十年趋势'] = df['收盘'].rolling(30).mean()
-        self.low_ages = ", ".join(map(str, lows[:6])) + (" 等" if len(lows)>6 else "")
+        df = pd.DataFrame({
+            "年龄": ages, "年份": self.birth_date.year + ages, "开盘": open_, "收盘": close,
+            "最高": close + swing, "最低": open_ - swing,
+            "状态": status, "当年大运": yuns,
+            "十年均线": ma10, "三十年趋势": ma30
+        })
+        self.low_ages = ", ".join(map(str, lows[:6])) + (" 等" if lows.size>6 else "")
         return df
 
     def generate_daily_kline(self, year):
-        start = date(year, 1, 1)
-        days = 366 if (year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)) else 365
-        data = []
-        price = 100.0
-        random.seed(self.seed + year)
-        for i in range(days):
-            curr = start + timedelta(days=i)
-            change = random.gauss(0, 3.5)
-            close = max(30, price + change)
-            data.append({"日期": curr, "开盘": price, "收盘": close, "最高": close + abs(change), "最低": price - abs(change)})
-            price = close
-        return pd.DataFrame(data)
+        return daily_kline(self.seed, year)
 
     def get_ai_context(self):
-        bazi_str = f"{self.year_pillar}　{self.month_pillar}　{self.day_pillar}　{self.time_pillar}"
         shensha_names = [s['name'] for s in self.shen_sha]
-        return f"性别:{self.gender}，出生:{self.birth_date} {self.hour}:{self.minute:02}，八字:{bazi_str}，日干河图数:{self.day_gan_num}，喜用神:{self.favored}，格局:{self.pattern[0]}，神煞:{shensha_names}"
+        return f"性别:{self.gender}，出生:{self.birth_date} {self.hour}:{self.minute:02}，八字:{self.bazi_str}，日干河图数:{self.day_gan_num}，喜用神:{self.favored}，格局:{self.pattern[0]}，神煞:{shensha_names}"
 
 # ==========================================
-# 5. 主程序（出生年倒序 + 流年日运文字中文）
+# 5. 排盘与图表缓存
 # ==========================================
+@st.cache_resource(ttl=3600, max_entries=256)
+def build_engine(b_date, hour, minute, lat, lng, gender):
+    # 排盘与百年K线只由出生信息决定，切换标签、拖动滑块等重跑直接命中缓存
+    engine = DestinyEngine(b_date, hour, minute, lat, lng, gender)
+    return engine, engine.generate_life_kline()
+
+@st.cache_resource(max_entries=64)
+def life_figure(key, _df_life):
+    # 人生K线只由排盘输入决定：同一 key 复用已建好的图，不再每次重跑都重建
+    # 轨迹以原生 dict 给出，由 go.Figure 一次性校验，避免先建 trace 对象再 add_trace 的二次校验与拷贝
+    ages = _df_life['年龄'].to_numpy()
+    fig = go.Figure(data=[
+        dict(type='candlestick', x=ages, open=_df_life['开盘'].to_numpy(), high=_df_life['最高'].to_numpy(),
+             low=_df_life['最低'].to_numpy(), close=_df_life['收盘'].to_numpy(),
+             increasing=dict(line=dict(color='#ff4081')), decreasing=dict(line=dict(color='#40c4ff')),
+             name='人生运势', customdata=_df_life[['当年大运', '状态']].to_numpy(),
+             hovertemplate="<b>%{x}岁（%{customdata[0]} · %{customdata[1]}）</b><br>开盘: %{open:.1f}<br>收盘: %{close:.1f}<extra></extra>"),
+        dict(type='scatter', x=ages, y=_df_life['十年均线'].to_numpy(), line=dict(color='#ffab40', width=3, dash='dot'), name='十年大运'),
+        dict(type='scatter', x=ages, y=_df_life['三十年趋势'].to_numpy(), line=dict(color='#7c4dff', width=3), name='一生趋势'),
+    ], layout=dict(height=600, template="plotly_dark", title=dict(text="你的人生运势曲线（独一无二）"),
+                   xaxis=dict(title=dict(text="年龄")), yaxis=dict(title=dict(text="运势能量"))))
+    return fig
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def daily_kline(seed, year):
+    # 日K只由引擎种子与年份决定：流年标签页与热力图共用同一份缓存
+    dates = pd.date_range(date(year, 1, 1), date(year, 12, 31))
+    changes = np.random.default_rng([seed, year]).normal(0, 3.5, len(dates))
+    close = floor_walk(changes, 100.0, 30)
+    open_ = np.concatenate(([100.0], close[:-1]))
+    swing = np.abs(changes)
+    return pd.DataFrame({"日期": dates, "开盘": open_, "收盘": close, "最高": close + swing, "最低": open_ - swing,
+                         "月": dates.month, "日": dates.day})
+
+@st.cache_resource(max_entries=64)
+def heatmap_figure(seed, year):
+    # plotly.express 导入与建图开销都大：仅在首次绘制热力图时导入，同一 (种子, 年份) 只建一次
+    import plotly.express as px
+    return px.density_heatmap(daily_kline(seed, year), x="日", y="月", z="收盘",
+                              color_continuous_scale="plasma", nbinsx=31, nbinsy=12,
+                              title=f"{year}年运势热力分布")
+
+# ==========================================
+# 6. 主程序（出生年倒序 + 流年日运文字中文）
+# ==========================================
+@st.fragment
+def daily_panel(engine):
+    # 拖动年份滑块只重跑本片段，不再触发整页重跑
+    # 流年查询滑块从1990开始
+    q_year = st.slider("选择查询年份", min_value=1990, max_value=datetime.now().year + 20, value=datetime.now().year, step=1)
+    df_daily = engine.generate_daily_kline(q_year)
+    # 图表骨架（样式、模板）每个会话只建一次，换年份时只替换数据与标题
+    if 'daily_fig' not in st.session_state:
+        st.session_state.daily_fig = go.Figure(
+            data=[dict(type='candlestick', name='每日运势',
+                       increasing=dict(line=dict(color='#ff1744')), decreasing=dict(line=dict(color='#00e676')))],
+            layout=dict(height=500, template="plotly_white"))
+    fig_d = st.session_state.daily_fig
+    with fig_d.batch_update():
+        fig_d.data[0].update(x=df_daily['日期'].to_numpy(), open=df_daily['开盘'].to_numpy(), high=df_daily['最高'].to_numpy(),
+                             low=df_daily['最低'].to_numpy(), close=df_daily['收盘'].to_numpy())
+        fig_d.layout.title.text = f"{q_year}年 · 每日运势波动"
+    st.plotly_chart(fig_d, use_container_width=True)
+
+@st.fragment
+def ai_panel(engine, api_key, api_base):
+    # 点击解盘按钮只重跑本片段，排盘与其余各页图表不再重算
+    st.markdown("### 🔮 AI 大师 · 终极解盘（融合河图洛书）")
+    if st.button("🧙‍♂️ 呼叫大师推演天机", type="primary"):
+        with st.spinner("大师正在观河图、布洛书..."):
+            analysis = call_ai_analysis(api_key, api_base, engine.get_ai_context())
+            st.markdown(f"<div style='background:#f3e5f5; padding:20px; border-radius:15px; border-left:6px solid #9c27b0;'>{analysis}</div>", unsafe_allow_html=True)
+    else:
+        st.info("配置密钥后点击，即可获得融合河图洛书数理的专属解盘")
+
 def main():
     with st.sidebar:
         st.markdown("<h2 style='text-align:center; color:#7b1fa2;'>🌟 天机控制台</h2>", unsafe_allow_html=True)
@@ -260,37 +412,35 @@ def main():
         minute = col_min.selectbox("分钟", range(60))
         
         st.markdown("#### 📍 出生地点（精确到县镇）")
-        full_addr = "北京市"
         if ADMIN_DATA:
-            provs = [p['name'] for p in ADMIN_DATA]
-            prov = st.selectbox("省份/直辖市", provs)
-            prov_d = next(p for p in ADMIN_DATA if p['name']==prov)
+            prov = st.selectbox("省份/直辖市", admin_names(()))
             
-            cities = prov_d.get('children', [])
-            if prov in ["北京市","上海市","天津市","重庆市"] and cities:
-                city_d = cities[0]
+            cities = admin_names((prov,))
+            if prov in ["北京市","上海市","天津市","重庆市"] and len(cities):
+                city_path = (prov, cities[0])
                 city = prov
             else:
-                city_names = [c['name'] for c in cities] if cities else [prov]
-                city = st.selectbox("地级市", city_names)
-                city_d = next(c for c in cities if c['name']==city) if cities else prov_d
-            
-            counties = city_d.get('children', [])
-            county_names = [c['name'] for c in counties] if counties else ["市辖区"]
-            county = st.selectbox("区/县", county_names)
-            county_d = next(c for c in counties if c['name']==county) if counties else city_d
+                city = st.selectbox("地级市", cities if len(cities) else (prov,))
+                city_path = (prov, city) if len(cities) else (prov,)
             
-            towns = county_d.get('children', [])
-            town_names = [t['name'] for t in towns] if towns else ["无镇/乡"]
-            town = st.selectbox("镇/乡/街道", town_names)
+            counties = admin_names(city_path)
+            county = st.selectbox("区/县", counties if len(counties) else ("市辖区",))
+            county_path = city_path + (county,) if len(counties) else city_path
             
-            detail = st.text_input("详细地址（如村、医院、门牌）", "人民医院")
-            full_addr = f"{prov}{city}{county}{town if town != '无镇/乡' else ''}{detail}"
+            towns = admin_names(county_path)
+            town = st.selectbox("镇/乡/街道", towns if len(towns) else ("无镇/乡",))
+            addr_prefix = f"{prov}{city}{county}{town if town != '无镇/乡' else ''}"
         else:
             st.warning("未加载区划数据，使用默认")
-            full_addr = st.text_input("手动输入完整地址", "北京市朝阳区三里屯")
         
-        if st.button("🛰️ 精准定位 & 排盘", type="primary", use_container_width=True):
+        # 地址输入放进表单：输入过程不触发整页重跑，点击按钮时才一并提交
+        with st.form("locate_form", border=False):
+            if ADMIN_DATA:
+                full_addr = addr_prefix + st.text_input("详细地址（如村、医院、门牌）", "人民医院")
+            else:
+                full_addr = st.text_input("手动输入完整地址", "北京市朝阳区三里屯")
+            located = st.form_submit_button("🛰️ 精准定位 & 排盘", type="primary", use_container_width=True)
+        if located:
             with st.spinner("天机正在推演..."):
                 loc_res = get_precise_location(full_addr)
                 st.session_state.loc = loc_res
@@ -298,81 +448,45 @@ def main():
 
     loc = st.session_state.get('loc', {'lat':39.9042, 'lng':116.4074})
     b_date = date(year, month, day)
-    engine = DestinyEngine(b_date, hour, minute, loc['lat'], loc['lng'], gender)
-    df_life = engine.generate_life_kline()
+    engine_key = (b_date, hour, minute, loc['lat'], loc['lng'], gender)
+    engine, df_life = build_engine(*engine_key)
 
     st.markdown(f"<h1 style='text-align:center;'>🌌 {name} · 全息命盘</h1>", unsafe_allow_html=True)
 
-    col1, col2, col3, col4, col5 = st.columns(5)
-    bazi_str = f"{engine.year_pillar}　{engine.month_pillar}　{engine.day_pillar}　{engine.time_pillar}"
-    col1.markdown(f"<div class='metric-box'><div class='metric-title'>八字</div><div class='metric-value'>{bazi_str}</div></div>", unsafe_allow_html=True)
-    col2.markdown(f"<div class='metric-box'><div class='metric-title'>格局</div><div class='metric-value'>{engine.pattern[0]}</div></div>", unsafe_allow_html=True)
-    col3.markdown(f"<div class='metric-box'><div class='metric-title'>喜用神</div><div class='metric-value'>{engine.favored}</div></div>", unsafe_allow_html=True)
-    col4.markdown(f"<div class='metric-box'><div class='metric-title'>虚岁</div><div class='metric-value'>{datetime.now().year - year + 1}</div></div>", unsafe_allow_html=True)
-    col5.markdown(f"<div class='metric-box'><div class='metric-title'>真太阳时差</div><div class='metric-value'>{engine.true_solar_diff:+.1f}分</div></div>", unsafe_allow_html=True)
+    metrics = [("八字", engine.bazi_str), ("格局", engine.pattern[0]), ("喜用神", engine.favored),
+               ("虚岁", datetime.now().year - year + 1), ("真太阳时差", f"{engine.true_solar_diff:+.1f}分")]
+    for col, (title, value) in zip(st.columns(5), metrics):
+        col.markdown(METRIC_HTML.format(title, value), unsafe_allow_html=True)
 
     tab1, tab2, tab3, tab4, tab5 = st.tabs(["📈 百年人生K线", "📅 流年日运", "🌟 神煞星耀", "🔥 运势热力图", "🔮 AI 大师解盘"])
 
     with tab1:
         st.markdown("### 📈 百年人生运势 · 专属K线（河图洛书 + 八字真实推演）")
-        fig = go.Figure()
-        fig.add_trace(go.Candlestick(
-            x=df_life['年龄'], open=df_life['开盘'], high=df_life['最高'],
-            low=df_life['最低'], close=df_life['收盘'],
-            increasing_line_color='#ff4081', decreasing_line_color='#40c4ff',
-            name='人生运势', text=df_life['当年大运'] + " · " + df_life['状态'],
-            hovertemplate="<b>%{x}岁（%{text}）</b><br>开盘: %{open:.1f}<br>收盘: %{close:.1f}<extra></extra>"
-        ))
-        fig.add_trace(go.Scatter(x=df_life['年龄'], y=df_life['十年均线'], line=dict(color='#ffab40', width=3, dash='dot'), name='十年大运'))
-        fig.add_trace(go.Scatter(x=df_life['年龄'], y=df_life['三十年趋势'], line=dict(color='#7c4dff', width=3), name='一生趋势'))
-        fig.update_layout(height=600, template="plotly_dark", title="你的人生运势曲线（独一无二）",
-                          xaxis_title="年龄", yaxis_title="运势能量")
+        fig = life_figure(engine_key, df_life)
         if engine.low_ages:
             st.warning(f"⚠️ 低谷年龄：{engine.low_ages}")
         st.plotly_chart(fig, use_container_width=True)
 
         st.markdown("#### 每年大运示例")
-        sample = df_life.iloc[::10][['年龄', '年份', '当年大运', '状态']]
+        sample = df_life.loc[::10, ['年龄', '年份', '当年大运', '状态']]
         st.dataframe(sample, use_container_width=True)
 
     with tab2:
         st.markdown("### 📅 流年每日运势")
-        # 流年查询滑块从1990开始
-        q_year = st.slider("选择查询年份", min_value=1990, max_value=datetime.now().year + 20, value=datetime.now().year, step=1)
-        df_daily = engine.generate_daily_kline(q_year)
-        fig_d = go.Figure(go.Candlestick(x=df_daily['日期'], open=df_daily['开盘'], high=df_daily['最高'],
-                                         low=df_daily['最低'], close=df_daily['收盘'],
-                                         increasing_line_color='#ff1744', decreasing_line_color='#00e676',
-                                         name='每日运势'))
-        fig_d.update_layout(height=500, template="plotly_white", title=f"{q_year}年 · 每日运势波动")
-        st.plotly_chart(fig_d, use_container_width=True)
+        daily_panel(engine)
 
     with tab3:
         st.markdown("### 🌟 命中神煞星耀")
         for item in engine.shen_sha:
-            st.markdown(f"<span class='shensha-tag tag-{item['type']}'>{item['name']}</span>　{item['desc']}", unsafe_allow_html=True)
+            st.markdown(SHENSHA_HTML.format_map(item), unsafe_allow_html=True)
         st.markdown(f"<br><small>格局评语：{engine.pattern[1]}</small>", unsafe_allow_html=True)
 
     with tab4:
         st.markdown("### 🔥 全年运势热力图（红旺蓝弱）")
-        current_year = datetime.now().year
-        df_daily = engine.generate_daily_kline(current_year)
-        df_daily['日期'] = pd.to_datetime(df_daily['日期'])
-        df_daily['月'] = df_daily['日期'].dt.month
-        df_daily['日'] = df_daily['日期'].dt.day
-        fig_heat = px.density_heatmap(df_daily, x="日", y="月", z="收盘", 
-                                     color_continuous_scale="plasma", nbinsx=31, nbinsy=12,
-                                     title=f"{current_year}年运势热力分布")
-        st.plotly_chart(fig_heat, use_container_width=True)
+        st.plotly_chart(heatmap_figure(engine.seed, datetime.now().year), use_container_width=True)
 
     with tab5:
-        st.markdown("### 🔮 AI 大师 · 终极解盘（融合河图洛书）")
-        if st.button("🧙‍♂️ 呼叫大师推演天机", type="primary"):
-            with st.spinner("大师正在观河图、布洛书..."):
-                analysis = call_ai_analysis(api_key, api_base, engine.get_ai_context())
-                st.markdown(f"<div style='background:#f3e5f5; padding:20px; border-radius:15px; border-left:6px solid #9c27b0;'>{analysis}</div>", unsafe_allow_html=True)
-        else:
-            st.info("配置密钥后点击，即可获得融合河图洛书数理的专属解盘")
+        ai_panel(engine, api_key, api_base)
 
 if __name__ == "__main__":
     if 'loc' not in st.session_state: